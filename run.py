@@ -1,16 +1,23 @@
 import os
 import yaml
+import asyncio
 from crewai import Agent, Task, Crew, Process
 from docx import Document
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import logging
 import time
 import random
+import hashlib
+import diskcache
+from collections import defaultdict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from src.docx_preserve import (
     extract_text_units, replace_text_in_document, 
-    calculate_optimal_batch_size, estimate_tokens, 
-    TokenStats, log_token_stats
+    build_batches, next_batch_end, estimate_tokens, estimate_tokens_batch,
+    AdaptiveBatchLimit, TokenStats, log_token_stats
 )
 
 
@@ -77,20 +84,179 @@ class TranslationTasks:
             agent=agent
         )
 
-    def translate_task(self, agent, doc_content, target_language):
-        return Task(
-            description=f"""Translate the ENTIRE academic text provided below into {target_language}.
+    def translate_prompt(self, doc_content, target_language, document_summary=""):
+        # Sent to Gemini directly rather than through a Crew so usage metadata comes back with the text
+        return f"""Translate the ENTIRE academic text provided below into {target_language}.
             You must translate everything accurately. Preserve the meaning, academic tone, and formatting like paragraphs and headings.
+
+            Document context: {document_summary}
             
             Full Text to Translate:
             ---
             {doc_content}
             ---
-            """,
-            expected_output=f"The full and complete translated text in {target_language}, formatted with Markdown.",
-            agent=agent,
-            async_execution=False # Ensures this complex task is handled patiently
-        )
+
+            Expected output: The full and complete translated text in {target_language}, as plain text without Markdown or other markup.
+            """
+
+
+def agent_instruction(agent):
+    """System instruction carrying the agent's persona into a direct Gemini call."""
+    return f"You are an {agent.role}. {agent.goal} {agent.backstory}"
+
+
+def gemini_model(agent):
+    """Build a Gemini client for the configured model, primed with the agent's persona."""
+    model_name = config['llm']['model_name'].removeprefix('gemini/')
+    return genai.GenerativeModel(model_name, system_instruction=agent_instruction(agent))
+
+
+def generate_translation(model, prompt):
+    """Call the model once and return the response text with its usage metadata."""
+    response = model.generate_content(prompt)
+    # .text raises ValueError when the response has no text parts (e.g. blocked),
+    # which the caller's retry loop treats like any other failed attempt
+    return response.text, response.usage_metadata
+
+
+def usage_token_stats(usage, prompt, completion, price_per_token=0.00001):
+    """TokenStats from the provider's reported usage, estimating any count it left out."""
+    input_tokens = getattr(usage, 'prompt_token_count', None) or estimate_tokens(prompt)
+    output_tokens = getattr(usage, 'candidates_token_count', None) or estimate_tokens(completion)
+    return TokenStats(
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        total_cost=(input_tokens + output_tokens) * price_per_token,  # Rough cost estimate
+    )
+
+
+BATCH_JOB_DONE_STATES = {
+    'JOB_STATE_SUCCEEDED', 'JOB_STATE_FAILED', 'JOB_STATE_CANCELLED', 'JOB_STATE_EXPIRED',
+}
+
+
+def run_batch_job(prompts, system_instruction):
+    """Submit prompts as one Gemini Batch API job, wait for it, and return (text, usage) pairs in order.
+
+    Requests that failed or came back without text (e.g. safety-blocked) yield (None, None).
+    """
+    try:
+        # The Batch API is only exposed by the newer google-genai SDK
+        from google import genai as google_genai
+    except ImportError as e:
+        raise ImportError("llm.mode 'batch' requires the google-genai package (pip install google-genai)") from e
+
+    client = google_genai.Client(api_key=API_KEY)
+    job = client.batches.create(
+        model=config['llm']['model_name'].removeprefix('gemini/'),
+        src=[
+            {
+                'contents': [{'role': 'user', 'parts': [{'text': prompt}]}],
+                'config': {'system_instruction': system_instruction},
+            }
+            for prompt in prompts
+        ],
+        config={'display_name': f"translate-{Path(config['paths']['input_file']).stem}"},
+    )
+    logging.info("Submitted batch job %s with %d requests", job.name, len(prompts))
+
+    poll_seconds = config['llm'].get('batch_poll_seconds', 60)
+    while job.state.name not in BATCH_JOB_DONE_STATES:
+        time.sleep(poll_seconds)
+        job = client.batches.get(name=job.name)
+        logging.info("Batch job %s: %s", job.name, job.state.name)
+    if job.state.name != 'JOB_STATE_SUCCEEDED':
+        raise RuntimeError(f"Batch job {job.name} ended in state {job.state.name}: {job.error}")
+
+    # Inline responses come back in request order
+    responses = []
+    for idx, inlined in enumerate(job.dest.inlined_responses):
+        text = inlined.response.text if inlined.response is not None else None
+        if inlined.error or text is None:
+            logging.warning("Batch job %s request %d returned no text: %s", job.name, idx, inlined.error)
+            responses.append((None, None))
+        else:
+            responses.append((text, inlined.response.usage_metadata))
+    return responses
+
+
+# Errors that mean the provider wants less load, not that the request was bad
+THROTTLING_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    TimeoutError,
+)
+
+
+def provider_retry_delay(error):
+    """Seconds the provider asked us to wait before retrying, or None if it didn't say."""
+    retry_delay = getattr(error, 'retry_delay', None)
+    if retry_delay is None:
+        # Gemini reports RetryInfo among the gRPC error details
+        for detail in getattr(error, 'details', None) or []:
+            retry_delay = getattr(detail, 'retry_delay', None)
+            if retry_delay is not None:
+                break
+    if retry_delay is not None:
+        if hasattr(retry_delay, 'total_seconds'):
+            return retry_delay.total_seconds()
+        return retry_delay.seconds + retry_delay.nanos / 1e9
+
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    retry_after = headers.get('Retry-After') if headers else None
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        try:
+            return (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+
+
+class ProviderThrottle:
+    """Shared pause that holds every worker back while the provider is rate limiting."""
+
+    def __init__(self):
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._resume_at = 0.0
+        self._holder = None
+        # Bumped whenever a new pause starts; lets workers tell a fresh throttle
+        # event from one that was already handled while their request was in flight
+        self.epoch = 0
+
+    async def wait(self):
+        await self._resume.wait()
+
+    def pause(self, seconds, request_epoch):
+        """Hold every worker for at least `seconds`.
+
+        Returns True only if no pause has started since the failed request was
+        sent (its `request_epoch`), i.e. this error opens a new throttle window.
+        """
+        loop = asyncio.get_running_loop()
+        new_window = request_epoch == self.epoch
+        self._resume_at = max(self._resume_at, loop.time() + seconds)
+        if self._resume.is_set():
+            self.epoch += 1
+            self._resume.clear()
+            self._holder = loop.create_task(self._hold())
+        return new_window
+
+    async def _hold(self):
+        loop = asyncio.get_running_loop()
+        while (remaining := self._resume_at - loop.time()) > 0:
+            await asyncio.sleep(remaining)
+        self._resume.set()
+
+
+def translation_cache_key(target_language, text):
+    """Cache key for a translated unit: model, target language and a digest of the source text."""
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+    return f"{config['llm']['model_name']}|{target_language}|{digest}"
 
 
 # --- 6. SCRIPT EXECUTION ---
@@ -123,84 +289,184 @@ def run_crew():
     units, src_doc = extract_text_units(input_path)
     logging.info("Found %d text units for translation", len(units))
 
-    # Agents
-    identification_agent = agents.identification_agent()
-    translator_agent = agents.translator_agent()
+    # Repeated text (headers, table labels, "N/A") is translated once and fanned out
+    unique = defaultdict(list)
+    for idx, u in enumerate(units):
+        # Numbers, URLs and symbol-only text are kept as-is without an LLM call
+        if u.type != "passthrough":
+            unique[u.text].append(idx)
+    logging.info("%d unique texts among %d units", len(unique), len(units))
 
-    # Identification task (context / prompt priming)
-    task_identify = tasks.identify_task(identification_agent, document_content)
+    # Reuse translations from previous runs; only cache misses go to the LLM
+    cache = diskcache.Cache(config['paths'].get('cache_dir', '.translate_cache'))
+    translations = {}
+    unique_units = []
+    for text, idxs in unique.items():
+        cached = cache.get(translation_cache_key(target_language, text))
+        if cached is not None:
+            translations[text] = cached
+        else:
+            unique_units.append(units[idxs[0]])
+    logging.info("%d texts served from cache, %d to translate", len(translations), len(unique_units))
 
-    # Calculate optimal batch size based on token limits
+    # Batches are cut just-in-time from the remaining units so the token cap can
+    # adapt to observed throughput and provider pushback as the run progresses
     max_tokens_per_batch = config['llm'].get('max_tokens_per_batch', 2000)
-    batch_size = calculate_optimal_batch_size(units, max_tokens_per_batch)
-    logging.info(f"Calculated optimal batch size: {batch_size} units")
+    batch_limit = AdaptiveBatchLimit(
+        current=max_tokens_per_batch,
+        ceiling=config['llm'].get('max_tokens_per_batch_ceiling', 4 * max_tokens_per_batch),
+    )
+    unit_tokens = estimate_tokens_batch([u.text for u in unique_units])
     
-    translated_map = []
-    total_batches = (len(units) + batch_size - 1) // batch_size
+    max_concurrency = config['llm'].get('max_concurrency', 8)
     total_stats = TokenStats()
-    
-    for i in range(0, len(units), batch_size):
-        batch = units[i:i+batch_size]
+    translator_model = gemini_model(agents.translator_agent())
+
+    # Identify the document once and inline the summary into every batch prompt
+    document_summary = ""
+    if unique_units:
+        identification_agent = agents.identification_agent()
+        task_identify = tasks.identify_task(identification_agent, document_content)
+        try:
+            document_summary = str(Crew(
+                agents=[identification_agent],
+                tasks=[task_identify],
+                process=Process.sequential,
+                verbose=False
+            ).kickoff())
+            logging.info("Document identified: %s", document_summary)
+        except Exception as e:
+            logging.warning("Document identification failed, translating without context: %s", e)
+
+    def split_translation(batch, translated_block):
+        parts = [p.strip() for p in translated_block.split("--- UNIT BREAK ---")]
+        if len(parts) != len(batch):
+            # Fallback: try naive split by double newline
+            parts = [p.strip() for p in translated_block.split("\n\n")]
+        if len(parts) == len(batch):
+            # Only cache cleanly aligned results so a bad split isn't replayed on reruns
+            for u, translated_text in zip(batch, parts):
+                cache.set(translation_cache_key(target_language, u.text), translated_text)
+        return parts
+
+    async def translate_batch(batch_num, first, batch, throttle):
         batch_text = "\n\n--- UNIT BREAK ---\n\n".join(u.text for u in batch)
-        
-        # Calculate input tokens for this batch
-        input_tokens = estimate_tokens(batch_text)
-        
-        task_translate = tasks.translate_task(translator_agent, batch_text, target_language)
-        task_translate.context = [task_identify]
-        crew = Crew(
-            agents=[identification_agent, translator_agent],
-            tasks=[task_translate],
-            process=Process.sequential,
-            verbose=False
-        )
-        
-        batch_num = (i // batch_size) + 1
-        logging.info(f"Translating batch {batch_num}/{total_batches} (units {i+1}-{min(i+batch_size, len(units))})")
+        prompt = tasks.translate_prompt(batch_text, target_language, document_summary)
 
         # Retry on transient provider errors (e.g., 503 overload)
         max_retries = 5
         attempt = 0
         translated_block = None
-        batch_stats = TokenStats()
         
+        logging.info(f"Translating batch {batch_num} (units {first+1}-{first+len(batch)} of {len(unique_units)}, "
+                     f"cap {batch_limit.current} tokens)")
         while attempt < max_retries:
             try:
-                translated_block = str(crew.kickoff())
+                await throttle.wait()
+                throttle_epoch = throttle.epoch
+                started = time.monotonic()
+                # The call blocks on the LLM round-trip; run it off the event loop
+                translated_block, usage = await asyncio.to_thread(generate_translation, translator_model, prompt)
+                elapsed = time.monotonic() - started
                 
-                # Calculate output tokens and update stats
-                output_tokens = estimate_tokens(translated_block)
-                batch_stats.input_tokens = input_tokens
-                batch_stats.output_tokens = output_tokens
-                batch_stats.total_cost = (input_tokens + output_tokens) * 0.00001  # Rough cost estimate
+                # Billable token counts as reported by the API
+                batch_stats = usage_token_stats(usage, prompt, translated_block)
+                batch_stats.latency_ms = elapsed * 1000
+                batch_limit.record(batch_stats.input_tokens + batch_stats.output_tokens, elapsed)
                 
                 # Log batch statistics
-                log_token_stats(batch_stats, batch_num, total_batches)
-                
-                # Update total stats
-                total_stats.input_tokens += input_tokens
-                total_stats.output_tokens += output_tokens
-                total_stats.total_cost += batch_stats.total_cost
-                
+                log_token_stats(batch_stats, batch_num)
                 break
             except Exception as e:
                 attempt += 1
                 if attempt >= max_retries:
                     raise
-                backoff_seconds = min(30, (2 ** attempt) + random.uniform(0, 1))
+                # Full jitter keeps concurrent workers from retrying in lockstep;
+                # an explicit delay from the provider takes precedence when longer
+                backoff_seconds = random.uniform(0, min(60, 2 ** attempt))
+                backoff_seconds = max(backoff_seconds, provider_retry_delay(e) or 0)
                 logging.warning(
-                    "Translation batch failed (attempt %d/%d): %s. Retrying in %.1fs",
-                    attempt, max_retries, e, backoff_seconds,
+                    "Translation batch %d failed (attempt %d/%d): %s. Retrying in %.1fs",
+                    batch_num, attempt, max_retries, e, backoff_seconds,
                 )
-                time.sleep(backoff_seconds)
-        parts = [p.strip() for p in translated_block.split("--- UNIT BREAK ---")]
-        if len(parts) != len(batch):
-            # Fallback: try naive split by double newline
-            parts = [p.strip() for p in translated_block.split("\n\n")]
+                if isinstance(e, THROTTLING_ERRORS):
+                    # Provider pushback: hold every worker, and shrink future batches once
+                    # per throttle window rather than once per worker that hit it
+                    if throttle.pause(backoff_seconds, throttle_epoch):
+                        batch_limit.penalize()
+                else:
+                    await asyncio.sleep(backoff_seconds)
+        return batch, split_translation(batch, translated_block), translated_block, batch_stats
+
+    async def translate_all():
+        # Batches are independent given the shared identify context, so up to
+        # max_concurrency workers each cut the next batch and keep one request in flight
+        results = []
+        next_start = 0
+        batch_count = 0
+        throttle = ProviderThrottle()
+
+        async def worker():
+            nonlocal next_start, batch_count
+            while next_start < len(unique_units):
+                first = next_start
+                next_start = next_batch_end(unit_tokens, first, batch_limit.current)
+                batch_count += 1
+                results.append(await translate_batch(batch_count, first, unique_units[first:next_start], throttle))
+
+        await asyncio.gather(*[worker() for _ in range(max_concurrency)])
+        return results
+
+    def translate_with_batch_api():
+        # Offline job: fixed batches submitted together at batch-tier pricing
+        batches = build_batches(unique_units, max_tokens_per_batch)
+        batch_texts = ["\n\n--- UNIT BREAK ---\n\n".join(u.text for u in batch) for batch in batches]
+        prompts = [tasks.translate_prompt(text, target_language, document_summary) for text in batch_texts]
+        responses = run_batch_job(prompts, agent_instruction(agents.translator_agent()))
+        results = []
+        failed = []
+        first = 0
+        for batch_num, (batch, prompt, (translated_block, usage)) in enumerate(zip(batches, prompts, responses), 1):
+            if translated_block is None:
+                failed.append((batch_num, first, batch))
+            else:
+                # Batch-tier tokens are billed at half price
+                batch_stats = usage_token_stats(usage, prompt, translated_block, price_per_token=0.000005)
+                log_token_stats(batch_stats, batch_num, len(batches))
+                results.append((batch, split_translation(batch, translated_block), translated_block, batch_stats))
+            first += len(batch)
+
+        if failed:
+            # Successful batches are already cached above, so a failure here loses none of the job's work
+            logging.warning("Retrying %d batch job requests without text through the realtime path", len(failed))
+
+            async def retry_failed():
+                throttle = ProviderThrottle()
+                return [await translate_batch(batch_num, first, batch, throttle) for batch_num, first, batch in failed]
+
+            results.extend(asyncio.run(retry_failed()))
+        return results
+
+    # Small jobs aren't worth the Batch API's turnaround time
+    use_batch_api = (
+        config['llm'].get('mode', 'realtime') == 'batch'
+        and len(unique_units) >= config['llm'].get('batch_min_units', 50)
+    )
+    if use_batch_api:
+        logging.info(f"Translating {len(unique_units)} units through the Gemini Batch API")
+        results = translate_with_batch_api()
+    else:
+        logging.info(f"Translating {len(unique_units)} units with up to {max_concurrency} batches in flight")
+        results = asyncio.run(translate_all())
+    for batch, parts, translated_block, batch_stats in results:
+        total_stats.input_tokens += batch_stats.input_tokens
+        total_stats.output_tokens += batch_stats.output_tokens
+        total_stats.total_cost += batch_stats.total_cost
         # Align best-effort
         for j, u in enumerate(batch):
-            translated_text = parts[j] if j < len(parts) else translated_block
-            translated_map.append((u, translated_text))
+            translations[u.text] = parts[j] if j < len(parts) else translated_block
+    translated_map = [(u, translations.get(u.text, u.text)) for u in units]
+    cache.close()
 
     # Log final statistics
     logging.info(f"Translation completed! Total stats - Input: {total_stats.input_tokens} tokens, "
@@ -213,7 +479,6 @@ def run_crew():
         logging.info("Saved DOCX: %s", output_path)
         print(f" DOCX written to: {output_path}")
     except PermissionError:
-        from datetime import datetime
         ts_path = (
             Path(output_path).with_stem(
                 f"{Path(output_path).stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
@@ -1,20 +1,44 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import List, Tuple, Dict, Optional
 from docx import Document
-from docx.text.paragraph import Paragraph
-from docx.table import _Cell, Table
 from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+from docx.opc.part import PartFactory, XmlPart
+from functools import lru_cache
+from lxml import etree
 import logging
+import os
+import re
+import tiktoken
+
+
+# python-docx has no footnotes part class and would load footnotes.xml as an opaque
+# blob; loading it as an XmlPart exposes the parsed tree and saves edits back
+PartFactory.part_type_for.setdefault(CT.WML_FOOTNOTES, XmlPart)
+
+_W_NS = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+# Compiled once; footnotes are queried per footnote and per paragraph
+_XP_FOOTNOTE = etree.XPath('./w:footnote', namespaces=_W_NS)
+_XP_P = etree.XPath('.//w:p', namespaces=_W_NS)
+_XP_T = etree.XPath('.//w:t', namespaces=_W_NS)
+_W_P = qn('w:p')
+_W_TBL = qn('w:tbl')
+_W_TR = qn('w:tr')
+_W_TC = qn('w:tc')
+_W_R = qn('w:r')
+_W_T = qn('w:t')
+_W_RPR = qn('w:rPr')
 
 
 @dataclass
 class TextUnit:
 	path: Tuple[int, ...]
 	text: str
-	type: str  # 'paragraph' | 'table_cell' | 'footnote'
+	type: str  # 'paragraph' | 'table_cell' | 'footnote' | 'passthrough'
 	footnote_id: Optional[int] = None  # For footnote references
+	element: Optional[etree._Element] = None  # The w:p holding the text, for body and table units
 
 
 @dataclass
@@ -22,26 +46,79 @@ class TokenStats:
 	input_tokens: int = 0
 	output_tokens: int = 0
 	total_cost: float = 0.0
+	latency_ms: float = 0.0
+
+
+@dataclass
+class AdaptiveBatchLimit:
+	"""Per-batch token cap that grows while throughput improves and shrinks on rate limits."""
+	current: int
+	ceiling: int
+	floor: int = 250
+	growth: float = 1.25
+	shrink: float = 0.7
+	window: int = 3
+	throughputs: List[float] = field(default_factory=list)
+
+	def __post_init__(self):
+		# A starting cap below the floor must never be raised by penalize()
+		self.floor = min(self.floor, self.current)
+
+	def record(self, tokens: int, elapsed: float):
+		"""Record a successful batch; grow the cap after `window` consecutive throughput gains."""
+		if elapsed <= 0:
+			return
+		self.throughputs.append(tokens / elapsed)
+		recent = self.throughputs[-self.window:]
+		if len(recent) == self.window and all(a < b for a, b in zip(recent, recent[1:])):
+			self.current = min(self.ceiling, int(self.current * self.growth))
+			self.throughputs.clear()
+
+	def penalize(self):
+		"""Shrink the cap after a rate-limit, overload or timeout error."""
+		self.current = max(self.floor, int(self.current * self.shrink))
+		self.throughputs.clear()
+
+
+_NUM_RE = re.compile(r'^[\d\s.,+\-×x%/()]+$')
+_WORD_RE = re.compile(r'[^\W\d_]{2,}')
+_URL_RE = re.compile(r'^(?:https?://|www\.)\S+$|^\S+@\S+\.\w+$', re.IGNORECASE)
+
+
+def is_translatable(text: str) -> bool:
+	"""Return False for numbers, URLs/emails and text without any word to translate."""
+	text = text.strip()
+	if not text or _NUM_RE.match(text) or _URL_RE.match(text):
+		return False
+	# Mixed references like "Below 183, 213" still carry prose; only text with
+	# no alphabetic word of two or more letters (symbols, "x = 3", "(a)") is kept verbatim
+	return _WORD_RE.search(text) is not None
 
 
 def extract_text_units(doc_path: str) -> Tuple[List[TextUnit], Document]:
 	doc = Document(doc_path)
 	units: List[TextUnit] = []
 
-	# Extract paragraphs
-	for p_idx, p in enumerate(doc.paragraphs):
-		text = p.text or ""
-		if text.strip():
-			units.append(TextUnit(path=(p_idx,), text=text, type="paragraph"))
-
-	# Extract table cells
-	for t_idx, tbl in enumerate(doc.tables):
-		for r_idx, row in enumerate(tbl.rows):
-			for c_idx, cell in enumerate(row.cells):
-				for p_idx, p in enumerate(cell.paragraphs):
+	# Walk the body's direct children once, in document order, rather than
+	# materializing Paragraph/Table/_Cell wrappers for every element
+	p_idx = t_idx = 0
+	for child in doc.element.body.iterchildren(_W_P, _W_TBL):
+		if child.tag == _W_P:
+			text = child.text or ""
+			if text.strip():
+				unit_type = "paragraph" if is_translatable(text) else "passthrough"
+				units.append(TextUnit(path=(p_idx,), text=text, type=unit_type, element=child))
+			p_idx += 1
+			continue
+
+		for r_idx, tr in enumerate(child.iterchildren(_W_TR)):
+			for c_idx, tc in enumerate(tr.iterchildren(_W_TC)):
+				for cp_idx, p in enumerate(tc.iterchildren(_W_P)):
 					text = p.text or ""
 					if text.strip():
-						units.append(TextUnit(path=(t_idx, r_idx, c_idx, p_idx), text=text, type="table_cell"))
+						unit_type = "table_cell" if is_translatable(text) else "passthrough"
+						units.append(TextUnit(path=(t_idx, r_idx, c_idx, cp_idx), text=text, type=unit_type, element=p))
+		t_idx += 1
 
 	# Extract footnotes
 	footnote_units = extract_footnotes(doc)
@@ -50,134 +127,182 @@ def extract_text_units(doc_path: str) -> Tuple[List[TextUnit], Document]:
 	return units, doc
 
 
+def _footnote_index(doc: Document) -> Dict[int, etree._Element]:
+	"""Map footnote ID to its w:footnote element, scanning the footnotes part once."""
+	footnotes_part = next(
+		(rel.target_part for rel in doc.part.rels.values() if rel.reltype == RT.FOOTNOTES and not rel.is_external),
+		None,
+	)
+	if not isinstance(footnotes_part, XmlPart):
+		return {}
+	footnotes_xml = footnotes_part.element
+	index = {}
+	for footnote_elem in _XP_FOOTNOTE(footnotes_xml):
+		footnote_id = footnote_elem.get(qn('w:id'))
+		if footnote_id:
+			index[int(footnote_id)] = footnote_elem
+	return index
+
+
 def extract_footnotes(doc: Document) -> List[TextUnit]:
 	"""Extract footnote content while preserving footnote IDs and references."""
 	units = []
 	
 	try:
-		# Access footnotes part
-		if hasattr(doc.part, 'footnotes_part') and doc.part.footnotes_part:
-			footnotes_part = doc.part.footnotes_part
-			footnotes_xml = footnotes_part.element
-			
-			# Find all footnote elements
-			for footnote_elem in footnotes_xml.findall('.//w:footnote', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}):
-				footnote_id = footnote_elem.get(qn('w:id'))
-				if footnote_id:
-					footnote_id = int(footnote_id)
-					
-					# Extract text from footnote paragraphs
-					for p_idx, p_elem in enumerate(footnote_elem.findall('.//w:p', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})):
-						text_parts = []
-						for t_elem in p_elem.findall('.//w:t', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}):
-							if t_elem.text:
-								text_parts.append(t_elem.text)
-						
-						footnote_text = ''.join(text_parts).strip()
-						if footnote_text:
-							units.append(TextUnit(
-								path=('footnote', footnote_id, p_idx),
-								text=footnote_text,
-								type="footnote",
-								footnote_id=footnote_id
-							))
+		for footnote_id, footnote_elem in _footnote_index(doc).items():
+			# Extract text from footnote paragraphs
+			for p_idx, p_elem in enumerate(_XP_P(footnote_elem)):
+				text_parts = []
+				for t_elem in _XP_T(p_elem):
+					if t_elem.text:
+						text_parts.append(t_elem.text)
+				
+				footnote_text = ''.join(text_parts).strip()
+				if footnote_text:
+					units.append(TextUnit(
+						path=('footnote', footnote_id, p_idx),
+						text=footnote_text,
+						type="footnote" if is_translatable(footnote_text) else "passthrough",
+						footnote_id=footnote_id
+					))
 	except Exception as e:
 		logging.warning(f"Could not extract footnotes: {e}")
 	
 	return units
 
 
+def _replace_runs(p_elem: etree._Element, text: str):
+	"""Replace a paragraph's text runs with a single run of text, keeping the first text run's formatting.
+
+	Runs without w:t (footnote references, drawings, field characters) stay where they are.
+	"""
+	text_runs = [r for r in p_elem.findall(_W_R) if r.find(_W_T) is not None]
+	r = OxmlElement('w:r')
+	r.text = text
+	if not text_runs:
+		p_elem.append(r)
+		return
+	first = text_runs[0]
+	rPr = first.find(_W_RPR)
+	if rPr is not None:
+		# rPr must be the run's first child; moving it out of the removed run needs no copy
+		r.insert(0, rPr)
+	first.addprevious(r)
+	for old in text_runs:
+		p_elem.remove(old)
+
+
 def replace_text_in_document(doc: Document, original_to_translated: List[Tuple[TextUnit, str]]) -> Document:
+	footnote_index = _footnote_index(doc)
 	for unit, translated in original_to_translated:
-		if unit.type == "paragraph" and len(unit.path) == 1:
-			p_idx = unit.path[0]
-			p: Paragraph = doc.paragraphs[p_idx]
-			for _ in range(len(p.runs)):
-				p.runs[0]._r.getparent().remove(p.runs[0]._r)
-			p.add_run(translated)
-		elif unit.type == "table_cell" and len(unit.path) == 4:
-			t_idx, r_idx, c_idx, p_idx = unit.path
-			tbl: Table = doc.tables[t_idx]
-			cell: _Cell = tbl.rows[r_idx].cells[c_idx]
-			p: Paragraph = cell.paragraphs[p_idx]
-			for _ in range(len(p.runs)):
-				p.runs[0]._r.getparent().remove(p.runs[0]._r)
-			p.add_run(translated)
+		if unit.type in ("paragraph", "table_cell") and unit.element is not None:
+			# Units point straight at their w:p, so no re-traversal of the document
+			_replace_runs(unit.element, translated)
 		elif unit.type == "footnote" and len(unit.path) == 3:
-			replace_footnote_text(doc, unit, translated)
+			replace_footnote_text(doc, unit, translated, footnote_index)
 	return doc
 
 
-def replace_footnote_text(doc: Document, unit: TextUnit, translated: str):
+def replace_footnote_text(doc: Document, unit: TextUnit, translated: str,
+		footnote_index: Optional[Dict[int, etree._Element]] = None):
 	"""Replace footnote text while preserving footnote structure and references."""
 	try:
-		if hasattr(doc.part, 'footnotes_part') and doc.part.footnotes_part:
-			footnotes_part = doc.part.footnotes_part
-			footnotes_xml = footnotes_part.element
+		if footnote_index is None:
+			footnote_index = _footnote_index(doc)
+		footnote_elem = footnote_index.get(unit.footnote_id)
+		if footnote_elem is None:
+			return
+
+		# Find the specific paragraph within the footnote
+		p_elements = _XP_P(footnote_elem)
+		p_idx = unit.path[2]  # The paragraph index within the footnote
+		
+		if p_idx < len(p_elements):
+			p_elem = p_elements[p_idx]
 			
-			# Find the specific footnote by ID
-			for footnote_elem in footnotes_xml.findall('.//w:footnote', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}):
-				footnote_id = footnote_elem.get(qn('w:id'))
-				if footnote_id and int(footnote_id) == unit.footnote_id:
-					# Find the specific paragraph within the footnote
-					p_elements = footnote_elem.findall('.//w:p', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})
-					p_idx = unit.path[2]  # The paragraph index within the footnote
-					
-					if p_idx < len(p_elements):
-						p_elem = p_elements[p_idx]
-						
-						# Remove existing text runs
-						for t_elem in p_elem.findall('.//w:t', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}):
-							t_elem.text = ""
-						
-						# Add new text
-						if p_elem.find('.//w:r', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}) is not None:
-							# Use existing run
-							run_elem = p_elem.find('.//w:r', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})
-							t_elem = run_elem.find('.//w:t', {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'})
-							if t_elem is not None:
-								t_elem.text = translated
-						else:
-							# Create new run
-							run_elem = OxmlElement('w:r')
-							t_elem = OxmlElement('w:t')
-							t_elem.text = translated
-							run_elem.append(t_elem)
-							p_elem.append(run_elem)
-					break
+			# Write into the first text node that has content and blank the ones after it.
+			# Leading runs without text (the footnoteRef mark) or with only the space
+			# after it are kept, matching the stripped text extract_footnotes produced
+			t_elems = _XP_T(p_elem)
+			start = next((i for i, t in enumerate(t_elems) if t.text and t.text.strip()), None)
+			if start is not None:
+				for t_elem in t_elems[start + 1:]:
+					t_elem.text = ""
+				t_elem = t_elems[start]
+			else:
+				# Create new run
+				run_elem = OxmlElement('w:r')
+				t_elem = OxmlElement('w:t')
+				run_elem.append(t_elem)
+				p_elem.append(run_elem)
+			t_elem.text = translated
+			if translated != translated.strip():
+				t_elem.set(qn('xml:space'), 'preserve')
 	except Exception as e:
 		logging.warning(f"Could not replace footnote text: {e}")
 
 
+@lru_cache(maxsize=1)
+def _get_encoder() -> Optional[tiktoken.Encoding]:
+	"""Load the BPE encoder for the configured model once per process."""
+	model_name = os.environ.get('OPENAI_MODEL_NAME', 'gpt-4o-mini')
+	try:
+		try:
+			return tiktoken.encoding_for_model(model_name)
+		except KeyError:
+			# Non-OpenAI models (e.g. gemini/...) have no registered encoding
+			return tiktoken.get_encoding('o200k_base')
+	except Exception as e:
+		logging.warning(f"Could not load tiktoken encoding, falling back to character estimate: {e}")
+		return None
+
+
 def estimate_tokens(text: str) -> int:
-	"""Rough token estimation: ~4 characters per token for most languages."""
-	return len(text) // 4
+	"""Count BPE tokens, falling back to ~4 characters per token without an encoder."""
+	enc = _get_encoder()
+	if enc is None:
+		return len(text) // 4
+	return len(enc.encode(text, disallowed_special=()))
 
 
-def calculate_optimal_batch_size(units: List[TextUnit], max_tokens_per_batch: int = 2000) -> int:
-	"""Calculate optimal batch size based on token limits."""
-	if not units:
-		return 1
-	
-	total_tokens = sum(estimate_tokens(unit.text) for unit in units)
-	if total_tokens <= max_tokens_per_batch:
-		return len(units)
-	
-	# Start with a conservative batch size and adjust
-	batch_size = max(1, len(units) // (total_tokens // max_tokens_per_batch + 1))
-	
-	# Verify the batch size doesn't exceed token limits
-	while batch_size > 1:
-		batch_tokens = sum(estimate_tokens(unit.text) for unit in units[:batch_size])
-		if batch_tokens <= max_tokens_per_batch:
-			break
-		batch_size = max(1, batch_size - 1)
-	
-	return batch_size
+def estimate_tokens_batch(texts: List[str]) -> List[int]:
+	"""Count tokens for many texts at once, encoding each distinct text only once."""
+	enc = _get_encoder()
+	if enc is None:
+		return [len(text) // 4 for text in texts]
+	unique_texts = list(dict.fromkeys(texts))
+	encoded = enc.encode_batch(unique_texts, num_threads=os.cpu_count() or 1, disallowed_special=())
+	counts = {text: len(tokens) for text, tokens in zip(unique_texts, encoded)}
+	return [counts[text] for text in texts]
 
 
-def log_token_stats(stats: TokenStats, batch_num: int, total_batches: int):
-	"""Log detailed token statistics."""
-	logging.info(f"Batch {batch_num}/{total_batches} - Input: {stats.input_tokens} tokens, "
-				f"Output: {stats.output_tokens} tokens, Cost: ${stats.total_cost:.4f}")
+def next_batch_end(unit_tokens: List[int], start: int, max_tokens: int) -> int:
+	"""Index one past the greedy batch starting at `start` that fits in max_tokens.
+
+	A single unit larger than max_tokens still gets a batch of its own.
+	"""
+	end, total = start, 0
+	while end < len(unit_tokens) and (end == start or total + unit_tokens[end] <= max_tokens):
+		total += unit_tokens[end]
+		end += 1
+	return end
 
+
+def build_batches(units: List[TextUnit], max_tokens: int = 2000) -> List[List[TextUnit]]:
+	"""Greedily pack consecutive units into batches of at most max_tokens each."""
+	unit_tokens = estimate_tokens_batch([unit.text for unit in units])
+	batches: List[List[TextUnit]] = []
+	start = 0
+	while start < len(units):
+		end = next_batch_end(unit_tokens, start, max_tokens)
+		batches.append(units[start:end])
+		start = end
+	return batches
+
+
+def log_token_stats(stats: TokenStats, batch_num: int, total_batches: Optional[int] = None):
+	"""Log detailed token statistics."""
+	label = f"{batch_num}/{total_batches}" if total_batches else f"{batch_num}"
+	latency = f", Latency: {stats.latency_ms:.0f} ms" if stats.latency_ms else ""
+	logging.info(f"Batch {label} - Input: {stats.input_tokens} tokens, "
+				f"Output: {stats.output_tokens} tokens, Cost: ${stats.total_cost:.4f}{latency}")
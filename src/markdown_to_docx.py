@@ -1,79 +1,109 @@
 import re
+from copy import deepcopy
 from docx import Document
-from docx.shared import Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
 
 
-def _apply_inline_formatting(paragraph, text):
-	bold_pattern = re.compile(r"\*\*(.+?)\*\*")
-	italic_pattern = re.compile(r"\*(.+?)\*")
+# Bold spans are matched first; italics only within the text between them
+_BOLD_RE = re.compile(r"\*\*(.+?)\*\*")
+_ITALIC_RE = re.compile(r"\*(.+?)\*")
 
+# One match per line: group 1/2 = heading level marker and text, group 3 = table row body
+_LINE_RE = re.compile(r"^(#{1,3}) (.*)$|^\|(.*)\|$")
+
+_HEADING_STYLES = ["Heading 1", "Heading 2", "Heading 3"]
+
+# Table rows are emitted at 10pt (w:sz is in half-points)
+_TABLE_FONT_HALF_POINTS = "20"
+
+
+def _make_run(text, bold=False, italic=False, size=None):
+	r = OxmlElement("w:r")
+	if bold or italic or size:
+		rPr = OxmlElement("w:rPr")
+		if bold:
+			rPr.append(OxmlElement("w:b"))
+		if italic:
+			rPr.append(OxmlElement("w:i"))
+		if size:
+			rPr.append(OxmlElement("w:sz", {qn("w:val"): size}))
+		r.append(rPr)
+	# CT_R's text setter is what add_run() uses: it splits on tabs into w:tab
+	# elements and sets xml:space="preserve" where needed
+	r.text = text
+	return r
+
+
+def _append_italic_runs(p, text):
 	pos = 0
-	segments = []
-	for m in bold_pattern.finditer(text):
+	for m in _ITALIC_RE.finditer(text):
 		start, end = m.span()
 		if start > pos:
-			segments.append((text[pos:start], None))
-		segments.append((m.group(1), "bold"))
+			p.append(_make_run(text[pos:start]))
+		p.append(_make_run(m.group(1), italic=True))
 		pos = end
 	if pos < len(text):
-		segments.append((text[pos:], None))
+		p.append(_make_run(text[pos:]))
 
-	for seg_text, kind in segments:
-		if kind == "bold":
-			run = paragraph.add_run(seg_text)
-			run.bold = True
-		else:
-			pos2 = 0
-			for it in italic_pattern.finditer(seg_text):
-				s2, e2 = it.span()
-				if s2 > pos2:
-					paragraph.add_run(seg_text[pos2:s2])
-				run = paragraph.add_run(it.group(1))
-				run.italic = True
-				pos2 = e2
-			if pos2 < len(seg_text):
-				paragraph.add_run(seg_text[pos2:])
+
+def _apply_inline_formatting(p, text):
+	pos = 0
+	for m in _BOLD_RE.finditer(text):
+		start, end = m.span()
+		if start > pos:
+			_append_italic_runs(p, text[pos:start])
+		p.append(_make_run(m.group(1), bold=True))
+		pos = end
+	if pos < len(text):
+		_append_italic_runs(p, text[pos:])
+
+
+def _make_pPr(style_id=None, jc=None):
+	pPr = OxmlElement("w:pPr")
+	if style_id:
+		pPr.append(OxmlElement("w:pStyle", {qn("w:val"): style_id}))
+	if jc:
+		pPr.append(OxmlElement("w:jc", {qn("w:val"): jc}))
+	return pPr
 
 
 def markdown_to_docx(markdown_text: str, output_path: str) -> None:
 	doc = Document()
 
+	# Paragraphs are built as raw w:p elements and attached to the body in one go,
+	# skipping python-docx's per-call style lookups; pPr templates are copied per use
+	heading_pPr = [_make_pPr(style_id=doc.styles[name].style_id) for name in _HEADING_STYLES]
+	table_pPr = _make_pPr(jc="left")
+	paragraphs = []
+
 	for raw_line in markdown_text.splitlines():
 		line = raw_line.rstrip()
+		p = OxmlElement("w:p")
+		paragraphs.append(p)
 		if not line:
-			doc.add_paragraph("")
 			continue
 
-		if line.startswith("### "):
-			p = doc.add_paragraph()
-			p.style = "Heading 3"
-			_apply_inline_formatting(p, line[4:])
-			continue
-		if line.startswith("## "):
-			p = doc.add_paragraph()
-			p.style = "Heading 2"
-			_apply_inline_formatting(p, line[3:])
-			continue
-		if line.startswith("# "):
-			p = doc.add_paragraph()
-			p.style = "Heading 1"
-			_apply_inline_formatting(p, line[2:])
-			continue
-
-		if line.startswith("|") and line.endswith("|") and "|" in line[1:]:
+		m = _LINE_RE.match(line)
+		if m is None:
+			_apply_inline_formatting(p, line)
+		elif m.group(1):
+			p.append(deepcopy(heading_pPr[len(m.group(1)) - 1]))
+			_apply_inline_formatting(p, m.group(2))
+		else:
 			cells = [c.strip() for c in line.strip("|").split("|")]
-			p = doc.add_paragraph()
-			p.alignment = WD_ALIGN_PARAGRAPH.LEFT
+			p.append(deepcopy(table_pPr))
 			for idx, cell in enumerate(cells):
-				r = p.add_run(cell)
-				r.font.size = Pt(10)
+				p.append(_make_run(cell, size=_TABLE_FONT_HALF_POINTS))
 				if idx < len(cells) - 1:
-					p.add_run("\t")
-			continue
+					tab_run = OxmlElement("w:r")
+					tab_run.append(OxmlElement("w:tab"))
+					p.append(tab_run)
 
-		p = doc.add_paragraph()
-		_apply_inline_formatting(p, line)
+	# Insert ahead of the trailing w:sectPr, which must stay the body's last child
+	body = doc.element.body
+	sectPr = body.find(qn("w:sectPr"))
+	insert_at = body.index(sectPr) if sectPr is not None else len(body)
+	body[insert_at:insert_at] = paragraphs
 
 	doc.save(output_path)
-